@@ -89,6 +89,12 @@ DIR_TEMP = "temp"
 # Donde irán los archivos del índice
 DIR_INDICE = "temp/indice"
 
+# Compress the index with zstandard, much faster to read than LZMA; the zstandard included
+# in CDPedia is built for the OS and Python version generating it, so only use it if
+# CDPedia will be run with those same ones (else it won't be able to read the index); it's
+# only included in CDPedia if this is set
+INDEX_ZSTD = False
+
 # Directorio destino de los archivos preprocesados.
 DIR_PREPROCESADO = DIR_TEMP + "/preprocesado"
 
@@ -146,6 +146,6 @@ def generate_from_html(dirbase, verbose):
         shutil.rmtree(config.DIR_INDICE)
     os.mkdir(config.DIR_INDICE)
 
-    Index.create(config.DIR_INDICE, gen())
+    Index.create(config.DIR_INDICE, gen(), zstd=config.INDEX_ZSTD)
     logger.info("Index created at %s", config.DIR_INDICE)
     return len(top_pages)
@@ -16,17 +16,34 @@
 
 
 import array
+import collections
+import concurrent.futures
 import logging
+import lzma
+import marshal
 import math
-import operator
 import os
 import pickle
 import random
+import threading
 import unicodedata
 import sqlite3
-from collections import defaultdict
+import struct
+from collections import OrderedDict, defaultdict
 from functools import lru_cache
-import lzma as best_compressor  # zlib is faster, lzma has better ratio.
+
+try:
+    import zstandard
+except ImportError:
+    # the index can still be created and read with its pages LZMA compressed
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    # it's needed to create the index, but when reading it it's only used (if it
+    # works in the running platform) to decode faster
+    numpy = None
 
 from src.armado import to3dirs
 
@@ -35,6 +52,64 @@ logger = logging.getLogger(__name__)
 PAGE_SIZE = 512
 MAX_RESULTS = 500
 
+# maximum size (in bytes of their data) of the pages kept in memory
+PAGE_CACHE_SIZE = 64 * 1024 * 1024
+
+# compression settings for the pages of documents data; the dictionary is trained
+# with the first pages when the index is created, and stored in the 'meta' table
+ZSTD_LEVEL = 19
+ZSTD_DICT_SIZE = 131072
+ZSTD_DICT_SAMPLES = 100
+ZSTD_DICT_KEY = "zstd_dict"
+
+# the compressed rows are tiny, so their frames don't carry the zstd magic number
+ZSTD_FORMAT = zstandard.FORMAT_ZSTD1_MAGICLESS if zstandard else None
+
+# first byte of the pages data, telling how the documents are stored; legacy pages
+# don't have it, they are a LZMA compressed pickle (always starting with 0xFD)
+PAGE_FORMAT_ROWS = b'\x01'  # each IndexEntry marshalled and zstd compressed by itself
+PAGE_FORMAT_COLUMNS = b'\x02'  # LZMA compressed marshal of the IndexEntry columns
+
+# header of the pages in rows format: quantity of rows and then the offset of each
+# compressed row (plus the end of the last one), from the page start
+ROWS_QUANTITY = struct.Struct('<H')
+ROWS_OFFSET = struct.Struct('<I')
+
+# marshal format for the pages, fixed so it's the same whatever Python builds it
+MARSHAL_VERSION = 4
+
+# queries used when reading the index; kept the same strings so the statements
+# cached by sqlite3 are reused
+SQL_SELECT_PAGE = "SELECT data FROM docs WHERE pageid = ?"
+SQL_SELECT_LAST_PAGE = "SELECT pageid, data FROM docs ORDER BY pageid DESC LIMIT 1"
+SQL_SELECT_PAGES = "SELECT pageid, data FROM docs ORDER BY pageid"
+SQL_SELECT_WORD_QUANTS = "SELECT word_quants FROM docs WHERE pageid = ?"
+SQL_SELECT_WORD = "SELECT word FROM tokens WHERE word = ?"
+SQL_SELECT_WORDS = "SELECT word FROM tokens"
+SQL_SELECT_TOKENS = "SELECT word, docsets AS 'ds [docset]' FROM tokens"
+SQL_SELECT_TOKENS_LIKE = SQL_SELECT_TOKENS + " WHERE word LIKE ?"
+SQL_SELECT_META = "SELECT value FROM meta WHERE name = ?"
+
+# staging of the words' DocSets when creating the index
+SQL_CREATE_STAGING = "CREATE TABLE staging (word TEXT, chunk BLOB)"
+SQL_INSERT_STAGING = "INSERT INTO staging (word, chunk) VALUES (?, ?)"
+SQL_SELECT_STAGING = "SELECT word, chunk FROM staging ORDER BY word, rowid"
+
+# quantity of (word, docid, position) kept in memory when creating the index, before
+# moving them to the staging table
+POSTINGS_BATCH_SIZE = 10000000
+
+# quantity of source items inserted together in the staging table to order them
+SOURCE_BATCH_SIZE = 10000
+
+# quantity of prepared statements cached by each connection
+CACHED_STATEMENTS = 256
+
+# below these sizes (encoded bytes, docids) the docids are faster decoded and
+# encoded in pure Python than with numpy
+VECTORIZED_DECODE_MIN = 128
+VECTORIZED_ENCODE_MIN = 256
+
 
 class IndexEntry:
     """Article or redir index entry data structure."""
@@ -93,39 +168,299 @@ def normalize_words(txt):
     return ''.join(txt_norm)
 
 
-def decompress_data(data):
-    return pickle.loads(best_compressor.decompress(data))
+class PageEntries:
+    """The documents of a page, stored by columns.
+
+    The IndexEntry is built only for the accessed document.
+    """
+
+    def __init__(self, columns):
+        self._columns = columns
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __getitem__(self, position):
+        return IndexEntry(*[column[position] for column in self._columns])
+
+
+class PageRows:
+    """The documents of a page, each one compressed by itself.
+
+    Only the accessed document is decompressed, and its IndexEntry built.
+    """
+
+    def __init__(self, data, compressor):
+        self._data = data
+        self._compressor = compressor
+        (quantity,) = ROWS_QUANTITY.unpack_from(data, len(PAGE_FORMAT_ROWS))
+        offsets_start = len(PAGE_FORMAT_ROWS) + ROWS_QUANTITY.size
+        offsets_format = '<{}I'.format(quantity + 1)
+        self._offsets = struct.unpack_from(offsets_format, data, offsets_start)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError("Non existing position in page")
+        start, end = self._offsets[position], self._offsets[position + 1]
+        row = marshal.loads(self._compressor.decompress(memoryview(self._data)[start:end]))
+        return IndexEntry(*row)
+
+
+class Compressor:
+    """Compress and decompress the pages of documents data.
+
+    Zstandard is used, optionally with a trained dictionary.
+    """
+
+    def __init__(self, dict_data=None):
+        self.dict_data = dict_data
+        if dict_data is None:
+            self._zstd_dict = None
+        else:
+            self._zstd_dict = zstandard.ZstdCompressionDict(dict_data)
+        # the dictionary id is not needed, it's always the one in the index
+        params = zstandard.ZstdCompressionParameters.from_level(
+            ZSTD_LEVEL, dict_size=len(dict_data or b""), format=ZSTD_FORMAT, write_dict_id=False)
+        self._compressor = zstandard.ZstdCompressor(
+            dict_data=self._zstd_dict, compression_params=params)
+
+        # decompressors can not be shared between threads, so each one builds its own
+        self._local = threading.local()
+
+    @classmethod
+    def train(cls, samples):
+        """Build a compressor with a dictionary trained from the samples.
+
+        If there is not enough data to train the dictionary, it is not used at all.
+        """
+        try:
+            zstd_dict = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples)
+        except zstandard.ZstdError as err:
+            logger.debug("Not using a compression dictionary: %s", err)
+            return cls()
+        return cls(zstd_dict.as_bytes())
+
+    def compress(self, data):
+        """Compress the data."""
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        """Decompress the data."""
+        try:
+            decompressor = self._local.decompressor
+        except AttributeError:
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=self._zstd_dict, format=ZSTD_FORMAT)
+            self._local.decompressor = decompressor
+        return decompressor.decompress(data)
+
+
+def encode_page(docs_data):
+    """Serialize each document of a page, before compressing them."""
+    return [marshal.dumps(tuple(getattr(entry, attr) for attr in IndexEntry.__slots__),
+                          MARSHAL_VERSION) for entry in docs_data]
+
+
+def compress_page(encoded, compressor):
+    """Compress each serialized document and join them, with their offsets, in a page."""
+    frames = [compressor.compress(row) for row in encoded]
+    offsets = []
+    position = len(PAGE_FORMAT_ROWS) + ROWS_QUANTITY.size + ROWS_OFFSET.size * (len(frames) + 1)
+    for frame in frames:
+        offsets.append(position)
+        position += len(frame)
+    offsets.append(position)
+    header = ROWS_QUANTITY.pack(len(frames)) + b''.join(map(ROWS_OFFSET.pack, offsets))
+    return PAGE_FORMAT_ROWS + header + b''.join(frames)
+
+
+def decompress_page(data, compressor):
+    """Return the documents of a page, and the size of the data kept for it.
+
+    Legacy pages, from indexes built before the page formats, are supported too.
+    """
+    page_format = data[:1]
+    if page_format == PAGE_FORMAT_ROWS:
+        if compressor is None:
+            raise RuntimeError("The zstandard module is needed to read this index")
+        return PageRows(data, compressor), len(data)
+    if page_format == PAGE_FORMAT_COLUMNS:
+        raw_data = lzma.decompress(data[1:])
+        return PageEntries(marshal.loads(raw_data)), len(raw_data)
+    raw_data = lzma.decompress(data)
+    return pickle.loads(raw_data), len(raw_data)
+
+
+def compress_columns_page(docs_data):
+    """Serialize a page by columns and compress it with LZMA (no zstandard needed)."""
+    columns = tuple([getattr(entry, attr) for entry in docs_data] for attr in IndexEntry.__slots__)
+    return PAGE_FORMAT_COLUMNS + lzma.compress(marshal.dumps(columns, MARSHAL_VERSION))
+
+
+def decompress_data(data, compressor):
+    return decompress_page(data, compressor)[0]
+
+
+# the compressors used in each of the worker processes when creating the index, by
+# their dictionary (it's the same for all the pages, so it's built only once)
+_worker_compressors = {}
+
+
+def _get_worker_compressor(dict_data):
+    """Return the compressor for the dictionary, in a worker process."""
+    compressor = _worker_compressors.get(dict_data)
+    if compressor is None:
+        compressor = _worker_compressors[dict_data] = Compressor(dict_data)
+    return compressor
+
+
+def _compress_encoded_page(page_id, word_quants, encoded, dict_data):
+    """Compress an already serialized page, in a worker process."""
+    compressor = _get_worker_compressor(dict_data)
+    return page_id, word_quants, compress_page(encoded, compressor)
+
+
+def _compress_page(page_id, word_quants, docs_data, dict_data):
+    """Serialize and compress a page, in a worker process."""
+    return _compress_encoded_page(page_id, word_quants, encode_page(docs_data), dict_data)
+
+
+def _compress_columns_page(page_id, word_quants, docs_data):
+    """Serialize and compress a page without zstandard, in a worker process."""
+    return page_id, word_quants, compress_columns_page(docs_data)
+
+
+class PageCache:
+    """LRU cache for the documents pages, limited by the total size of them."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pageid):
+        """Return the cached page, None if not there."""
+        with self._lock:
+            try:
+                self._pages.move_to_end(pageid)
+            except KeyError:
+                return None
+            return self._pages[pageid][1]
+
+    def put(self, pageid, page, size):
+        """Store a page, evicting the least recently used ones if needed.
+
+        The last stored page is always kept, even if bigger than the cache limit.
+        """
+        with self._lock:
+            if pageid in self._pages:
+                self.size -= self._pages.pop(pageid)[0]
+            self._pages[pageid] = (size, page)
+            self.size += size
+            while self.size > self.max_size and len(self._pages) > 1:
+                old_size, _ = self._pages.popitem(last=False)[1]
+                self.size -= old_size
 
 
 class DocSet:
-    """Data type to encode, decode & compute documents-id's sets."""
+    """Data type to encode, decode & compute documents-id's sets.
+
+    The (docid, position) pairs are kept in two flat arrays, in the order they were
+    appended; they are only sorted when needed if not appended in order (when indexing
+    it's always ordered, as documents are processed one after the other).
+    """
     SEPARATOR = 0xFF
+    _SEPARATOR_BYTE = bytes((SEPARATOR,))
 
     def __init__(self):
-        self._docs_list = defaultdict(list)
-        self.items = self._docs_list.items
+        self._docs = array.array('I')
+        self._positions = array.array('B')
+        self._ordered = True
 
     def append(self, docid, position):
         """Append an item to the docs_list."""
-        self._docs_list[docid].append(position)
+        if self._docs:
+            last_docid = self._docs[-1]
+            if docid < last_docid or (docid == last_docid and position < self._positions[-1]):
+                self._ordered = False
+        try:
+            self._positions.append(position)
+        except OverflowError:
+            raise ValueError("Positions can't be greater than 254.")
+        self._docs.append(docid)
+
+    def extend(self, other):
+        """Add all the pairs of other DocSet, whose docids must be greater than these."""
+        self._docs.extend(other._docs)
+        self._positions.extend(other._positions)
+
+    @classmethod
+    def from_arrays(cls, docs, positions):
+        """Build a DocSet from docids and positions buffers, already ordered."""
+        docset = cls()
+        docset._docs.frombytes(docs.tobytes())
+        docset._positions.frombytes(positions.tobytes())
+        return docset
+
+    def _sort(self):
+        """Order the pairs by docid and position, if they were not appended that way."""
+        if self._ordered:
+            return
+        if numpy is None:
+            pairs = sorted(zip(self._docs, self._positions))
+            self._docs = array.array('I', [docid for docid, _ in pairs])
+            self._positions = array.array('B', [position for _, position in pairs])
+            self._ordered = True
+            return
+        docs = numpy.frombuffer(self._docs, dtype=self._docs.typecode)
+        positions = numpy.frombuffer(self._positions, dtype=self._positions.typecode)
+        order = numpy.lexsort((positions, docs))
+        self._docs = array.array('I', docs[order].tobytes())
+        self._positions = array.array('B', positions[order].tobytes())
+        self._ordered = True
+
+    def items(self):
+        """Return the docids with the list of their positions."""
+        docs_list = defaultdict(list)
+        for docid, position in zip(self._docs, self._positions):
+            docs_list[docid].append(position)
+        return docs_list.items()
 
     def __len__(self):
-        return len(self._docs_list)
+        """Return the quantity of different docids."""
+        if not self._docs:
+            return 0
+        # once ordered, the docids only change from one document to the next
+        self._sort()
+        docs = self._docs
+        if numpy is None:
+            return 1 + sum(1 for prev, docid in zip(docs, docs[1:]) if docid != prev)
+        docs = numpy.frombuffer(docs, dtype=docs.typecode)
+        return int(numpy.count_nonzero(numpy.diff(docs))) + 1
 
     def __repr__(self):
-        value = repr(self._docs_list).replace("[", "").replace("],", "|").replace("]})", "}")
-        curly = value.index("{")
-        value = value[curly:curly + 75]
+        value = repr(dict(self.items()))
+        value = value.replace("[", "").replace("],", "|").replace("]}", "}")
+        value = value[:75]
         if not value.endswith("}"):
             value += " ..."
-        return "<Docset: len={} {}>".format(len(self._docs_list), value)
+        return "<Docset: len={} {}>".format(len(self), value)
 
     def __eq__(self, other):
-        return self._docs_list == other._docs_list
+        self._sort()
+        other._sort()
+        return self._docs == other._docs and self._positions == other._positions
 
     @staticmethod
     def delta_encode(ordered):
         """Compress an array of numbers into a bytes object."""
+        if numpy is not None and len(ordered) >= VECTORIZED_ENCODE_MIN:
+            return DocSet._delta_encode_vectorized(ordered)
+
         result = array.array('B')
         add_to_result = result.append
 
@@ -146,6 +481,27 @@ class DocSet:
 
         return result.tobytes()
 
+    @staticmethod
+    def _delta_encode_vectorized(ordered):
+        """Compress an array of numbers into a bytes object, all at once using numpy."""
+        deltas = numpy.diff(numpy.asarray(ordered, dtype=numpy.uint64), prepend=numpy.uint64(0))
+
+        # quantity of 7b chunks needed by each number (at most five passes for 32b values)
+        nbytes = numpy.ones(len(deltas), dtype=numpy.intp)
+        rest = deltas >> numpy.uint64(7)
+        while rest.any():
+            nbytes += rest > 0
+            rest >>= numpy.uint64(7)
+
+        # spread every number in its chunks, all flagged but the last one of each number
+        ends = numpy.cumsum(nbytes)
+        owner = numpy.repeat(numpy.arange(len(deltas)), nbytes)
+        shifts = ((numpy.arange(ends[-1]) - (ends - nbytes)[owner]) * 7).astype(numpy.uint64)
+        result = ((deltas[owner] >> shifts) & numpy.uint64(0x7F)).astype(numpy.uint8)
+        result |= 0x80
+        result[ends - 1] &= 0x7F
+        return result.tobytes()
+
     @staticmethod
     def delta_decode(ordered):
         """Decode a compressed encoded bucket.
@@ -154,6 +510,9 @@ class DocSet:
         - ctor is the final container
         - append is the callable attribute used to add an element into the ctor
         """
+        if numpy is not None and len(ordered) >= VECTORIZED_DECODE_MIN:
+            return DocSet._delta_decode_vectorized(ordered)
+
         result = []
         add_to_result = result.append
 
@@ -171,23 +530,35 @@ class DocSet:
 
         return result
 
+    @staticmethod
+    def _delta_decode_vectorized(ordered):
+        """Decode a compressed encoded bucket, all bytes at once using numpy."""
+        buf = numpy.frombuffer(ordered, dtype=numpy.uint8)
+        # each number ends in the byte without the continuation flag
+        ends = numpy.flatnonzero(buf < 0x80)
+        if not len(ends):
+            return []
+        buf = buf[:ends[-1] + 1]
+        starts = numpy.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+
+        # shift each 7b chunk according to its position inside its number, and join them
+        shifts = (numpy.arange(len(buf)) - numpy.repeat(starts, ends - starts + 1)) * 7
+        chunks = (buf & 0x7F).astype(numpy.uint64) << shifts.astype(numpy.uint64)
+        deltas = numpy.add.reduceat(chunks, starts)
+        return numpy.cumsum(deltas).tolist()
+
     def encode(self):
         """Encode to store compressed inside the database."""
-        if not self._docs_list:
+        if not self._docs:
             return ""
-        docs_list = []
-        for key, values in self._docs_list.items():
-            docs_list.extend((key, value) for value in values)
-        docs_list.sort()
-        docs = [v[0] for v in docs_list]
-        docs_enc = DocSet.delta_encode(docs)
-        # if any score is greater than 255 or lesser than 1, it won't work
-        position = [v[1] for v in docs_list]
-        if any([x >= self.SEPARATOR for x in position]):
+        self._sort()
+        positions = self._positions.tobytes()
+        # the separator can not be used as a position (and bigger ones don't fit a byte)
+        if self.SEPARATOR in positions:
             raise ValueError("Positions can't be greater than 254.")
-        position.append(self.SEPARATOR)
-        position = array.array("B", position)
-        return position.tobytes() + docs_enc
+        return positions + self._SEPARATOR_BYTE + DocSet.delta_encode(self._docs)
 
     @classmethod
     def decode(cls, encoded):
@@ -195,14 +566,101 @@ class DocSet:
         docset = cls()
         if len(encoded) > 1:
             limit = encoded.index(cls.SEPARATOR)
-            docsid = cls.delta_decode(encoded[limit + 1:])
-            positions = array.array('B')
-            positions.frombytes(encoded[:limit])
-            for docid, position in zip(docsid, positions):
-                docset._docs_list[docid].append(position)
+            docset._positions.frombytes(encoded[:limit])
+            docset._docs.fromlist(cls.delta_decode(encoded[limit + 1:]))
         return docset
 
 
+class Postings:
+    """Collect the words of the documents being indexed, to build all the DocSets at once.
+
+    Every (word, docid, position) is stored in flat arrays (with the words mapped to ids),
+    and they are grouped by word with one stable sort, which keeps the pairs in the
+    order they were added.
+
+    If a database is given, to bound the memory used, every time the batch of pairs
+    gets too big it is grouped and its DocSets are stored in a staging table; in the
+    end all the stored chunks of each word are joined.
+    """
+
+    def __init__(self, database=None, batch_size=None):
+        self.word_ids = {}
+        self._words_by_id = []
+        self._database = database
+        self._batch_size = POSTINGS_BATCH_SIZE if batch_size is None else batch_size
+        self._staged = False
+        self._new_batch()
+
+    def _new_batch(self):
+        """Start a new batch of pairs."""
+        self._words = array.array('I')
+        self._docs = array.array('I')
+        self._positions = array.array('B')
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def add(self, docid, words):
+        """Add the words of a document; docids must be added in increasing order."""
+        if len(words) > DocSet.SEPARATOR:
+            raise ValueError("Positions can't be greater than 254.")
+        word_ids = self.word_ids
+        for word in words:
+            word_id = word_ids.get(word)
+            if word_id is None:
+                word_id = word_ids[word] = len(word_ids)
+                self._words_by_id.append(word)
+            self._words.append(word_id)
+        self._docs.extend([docid] * len(words))
+        self._positions.extend(range(len(words)))
+
+        if self._database is not None and len(self._words) >= self._batch_size:
+            self._stage()
+
+    def _group(self):
+        """Yield every word in the current batch with its DocSet."""
+        words = numpy.frombuffer(self._words, dtype=self._words.typecode)
+        order = numpy.argsort(words, kind='stable')
+        counts = numpy.bincount(words, minlength=len(self.word_ids))
+        ends = numpy.cumsum(counts)
+        docs = numpy.frombuffer(self._docs, dtype=self._docs.typecode)[order]
+        positions = numpy.frombuffer(self._positions, dtype=self._positions.typecode)[order]
+
+        for word, count, end in zip(self._words_by_id, counts, ends):
+            if count:
+                start = end - count
+                yield word, DocSet.from_arrays(docs[start:end], positions[start:end])
+
+    def _stage(self):
+        """Store the DocSets of the current batch in the staging table, and clean it."""
+        if not self._staged:
+            self._database.execute(SQL_CREATE_STAGING)
+            self._staged = True
+        self._database.executemany(
+            SQL_INSERT_STAGING, ((word, docset.encode()) for word, docset in self._group()))
+        self._new_batch()
+
+    def docsets(self):
+        """Yield every word with its DocSet."""
+        if not self._staged:
+            yield from self._group()
+            return
+
+        # join all the chunks of each word, that were staged in docids order
+        self._stage()
+        cur = self._database.execute(SQL_SELECT_STAGING)
+        current_word = docset = None
+        for word, chunk in cur:
+            if word == current_word:
+                docset.extend(DocSet.decode(chunk))
+                continue
+            if docset is not None:
+                yield current_word, docset
+            current_word, docset = word, DocSet.decode(chunk)
+        if docset is not None:
+            yield current_word, docset
+
+
 def open_connection(filename):
     """Connect and register data types and aggregate function."""
     # Register the adapter
@@ -215,7 +673,8 @@ def open_connection(filename):
         return DocSet.decode(s)
     sqlite3.register_converter("docset", convert_docset)
 
-    con = sqlite3.connect(filename, check_same_thread=False, detect_types=sqlite3.PARSE_COLNAMES)
+    con = sqlite3.connect(filename, check_same_thread=False, detect_types=sqlite3.PARSE_COLNAMES,
+                          cached_statements=CACHED_STATEMENTS)
     return con
 
 
@@ -230,10 +689,15 @@ def to_filename(title):
         raise ValueError("Title must have at least one character")
 
     dir3, arch = to3dirs.get_path_file(tt)
-    expected = os.path.join(dir3, arch)
+    # same as os.path.join, the shape is always the same
+    expected = dir3 + os.sep + arch
     return expected
 
 
+# when reading the index the same titles are asked again and again
+_cached_filename = lru_cache(1024)(to_filename)
+
+
 class Search:
     """Fetch and order some search."""
     def __init__(self, db, keys):
@@ -264,7 +728,7 @@ class Search:
     @lru_cache(1000)
     def _get_page(self, pageid):
         """Return the array of word_quants in word of a page's titles."""
-        cur = self.db.execute("SELECT word_quants FROM docs where pageid = ?", (pageid,))
+        cur = self.db.execute(SQL_SELECT_WORD_QUANTS, (pageid,))
         row = cur.fetchone()
         decomp_data = array.array("B")
         if row:
@@ -291,10 +755,8 @@ class Search:
 
     def _fetch(self, key):
         """Return all the values of a partial key search."""
-        sql = "select word, docsets as 'ds [docset]' from tokens"
-        sql += " where word like '%{}%'".format(key)
-        cur = self.db.execute(sql)
-        for row in cur.fetchall():
+        cur = self.db.execute(SQL_SELECT_TOKENS_LIKE, ("%{}%".format(key),))
+        for row in cur:
             yield row[0], row[1]
 
     def iterative_levenshtein(self, phrase):
@@ -355,7 +817,7 @@ class Search:
 class Index:
     """Handle the index."""
 
-    def __init__(self, directory):
+    def __init__(self, directory, page_cache_size=PAGE_CACHE_SIZE):
         self._directory = directory
         keyfilename = os.path.join(directory, "index.sqlite")
         self.db = open_connection(keyfilename)
@@ -364,36 +826,53 @@ class Index:
             PRAGMA journal_mode = MEMORY;
             PRAGMA temp_store = MEMORY;
             PRAGMA synchronous = OFF;
+            PRAGMA cache_size = -65536;
+            PRAGMA mmap_size = 268435456;
             ''')
+        self._page_cache = PageCache(page_cache_size)
+        if zstandard is None:
+            self._compressor = None
+        else:
+            self._compressor = Compressor(self._get_meta(ZSTD_DICT_KEY))
+
+    def _get_meta(self, name):
+        """Return a value from the meta table, None if not there (or no table at all)."""
+        try:
+            cur = self.db.execute(SQL_SELECT_META, (name,))
+        except sqlite3.OperationalError:
+            # legacy index, without meta information
+            return None
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        return None
 
     def keys(self):
         """Return an iterator over the stored keys."""
-        cur = self.db.execute("SELECT word FROM tokens")
-        for row in cur.fetchall():
+        cur = self.db.execute(SQL_SELECT_WORDS)
+        for row in cur:
             yield row[0]
 
     def items(self):
         """Return an iterator over the stored items."""
-        sql = "select word, docsets as 'ds [docset]' from tokens"
-        cur = self.db.execute(sql)
-        for row in cur.fetchall():
+        cur = self.db.execute(SQL_SELECT_TOKENS)
+        for row in cur:
             yield row[0], row[1]
 
     def values(self):
         """Return an iterator over the stored values."""
-        cur = self.db.execute("SELECT pageid, data FROM docs ORDER BY pageid")
-        for row in cur.fetchall():
-            decomp_data = decompress_data(row[1])
+        cur = self.db.execute(SQL_SELECT_PAGES)
+        for row in cur:
+            decomp_data = decompress_data(row[1], self._compressor)
             for doc in decomp_data:
                 yield doc
 
     @lru_cache(1)
     def __len__(self):
         """Compute the total number of docs in compressed pages."""
-        sql = "Select pageid, data from docs order by pageid desc limit 1"
-        cur = self.db.execute(sql)
+        cur = self.db.execute(SQL_SELECT_LAST_PAGE)
         row = cur.fetchone()
-        decomp_data = decompress_data(row[1])
+        decomp_data = decompress_data(row[1], self._compressor)
         return row[0] * PAGE_SIZE + len(decomp_data)
 
     def random(self):
@@ -403,19 +882,22 @@ class Index:
 
     def __contains__(self, key):
         """Return if the key is in the index or not."""
-        cur = self.db.execute("SELECT word FROM tokens where word = ?", (key,))
+        cur = self.db.execute(SQL_SELECT_WORD, (key,))
         if cur.fetchone():
             return True
         return False
 
-    @lru_cache(1000)
     def _get_page(self, pageid):
         """Get a page of doc entry data."""
-        cur = self.db.execute("SELECT data FROM docs where pageid = ?", (pageid,))
+        page = self._page_cache.get(pageid)
+        if page is not None:
+            return page
+        cur = self.db.execute(SQL_SELECT_PAGE, (pageid,))
         row = cur.fetchone()
         if row:
-            decomp_data = decompress_data(row[0])
-            return decomp_data
+            page, size = decompress_page(row[0], self._compressor)
+            self._page_cache.put(pageid, page, size)
+            return page
         return None
 
     def _get_raw_doc(self, docid):
@@ -426,7 +908,7 @@ class Index:
             raise IndexError("Non existing docid")
         idx_entry = data[rel_position]
         if idx_entry.rtype == IndexEntry.TYPE_ORIG_SIMPLE_LINK:
-            idx_entry.link = to_filename(idx_entry.title)
+            idx_entry.link = _cached_filename(idx_entry.title)
         return idx_entry
 
     def get_doc(self, docid):
@@ -463,17 +945,26 @@ class Index:
                 break
 
     @classmethod
-    def create(cls, directory, source):
+    def create(cls, directory, source, zstd=False):
         """Create the index in the directory.
 
         The source must give path, page_score, title and
         a list of extracted words from title in an ordered fashion
         It must return the quantity of pairs indexed.
+
+        If zstd, the documents are compressed with zstandard (each one by itself, so
+        they are fast to read), else (or if it's not installed) each page is serialized
+        by columns and LZMA compressed, that can be read with just the standard library.
         """
-        import pickletools
         import time
         from progress.bar import Bar
 
+        if numpy is None:
+            raise RuntimeError("The numpy module is needed to create the index")
+        if zstd and zstandard is None:
+            logger.warning("The zstandard module is not installed, using LZMA")
+            zstd = False
+
         class SQLmany:
             """Execute many INSERTs greatly improves the performance."""
             def __init__(self, name, sql, quantity):
@@ -506,30 +997,99 @@ class Index:
             def persist(self):
                 """Commit data to index."""
                 database.executemany(self.sql, self.buffer)
-                database.commit()
 
         class Compressed(SQLmany):
             """Creates the table of compressed documents information.
 
-            The groups is PAGE_SIZE word_quant, pickled and compressed."""
+            The groups is PAGE_SIZE word_quant, each document serialized and compressed
+            by itself.
+
+            The first pages are hold until having enough samples to train the
+            compression dictionary; after that, pages are serialized and compressed
+            by a pool of processes, and stored in the same order they were generated.
+
+            If not using zstandard, each page is serialized by columns and LZMA
+            compressed, with no pages hold.
+            """
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.executor = None
+                self.dict_data = None
+                self.pending = []
+                self.futures = collections.deque()
+                self.max_futures = 2 * (os.cpu_count() or 1)
+                if not zstd:
+                    self.executor = concurrent.futures.ProcessPoolExecutor()
+
+            def finish(self):
+                """Store all the pages still being compressed."""
+                super().finish()
+                if self.executor is None:
+                    self.flush_pending()
+                self.store_compressed(wait_all=True)
+                self.executor.shutdown()
+
             def persist(self):
-                """Compress and commit data to index."""
+                """Send the page to be compressed, storing the already finished ones."""
                 docs_data = []
                 word_quants = array.array("B")
                 for word_quant, data in self.buffer:
                     word_quants.append(word_quant)
                     docs_data.append(data)
-                pickdata = pickletools.optimize(pickle.dumps(docs_data))
-                comp_data = best_compressor.compress(pickdata)
                 page_id = (self.count - 1) // PAGE_SIZE
-                database.execute(self.sql, (page_id, word_quants.tobytes(), comp_data))
-                database.commit()
+                if self.executor is None:
+                    self.pending.append((page_id, word_quants.tobytes(), encode_page(docs_data)))
+                    if len(self.pending) >= ZSTD_DICT_SAMPLES:
+                        self.flush_pending()
+                    return
+                if zstd:
+                    future = self.executor.submit(
+                        _compress_page, page_id, word_quants.tobytes(), docs_data, self.dict_data)
+                else:
+                    future = self.executor.submit(
+                        _compress_columns_page, page_id, word_quants.tobytes(), docs_data)
+                self.futures.append(future)
+                self.store_compressed()
+
+            def flush_pending(self):
+                """Train the compressor and send to compress the pages hold so far."""
+                samples = [row for _, _, encoded in self.pending for row in encoded]
+                compressor = Compressor.train(samples)
+                if compressor.dict_data is not None:
+                    database.execute(
+                        "INSERT INTO meta (name, value) VALUES (?, ?)",
+                        (ZSTD_DICT_KEY, compressor.dict_data))
+                # the dictionary goes with each page, the workers build its compressor once
+                self.dict_data = compressor.dict_data
+                self.executor = concurrent.futures.ProcessPoolExecutor()
+                for page_id, word_quants, encoded in self.pending:
+                    self.futures.append(self.executor.submit(
+                        _compress_encoded_page, page_id, word_quants, encoded, self.dict_data))
+                self.pending = []
+
+            def store_compressed(self, wait_all=False):
+                """Store the compressed pages, in order.
+
+                Only the pages already compressed are stored, unless there are too
+                many being compressed (or all of them are requested).
+                """
+                rows = []
+                while self.futures:
+                    must_wait = wait_all or len(self.futures) > self.max_futures
+                    if not (must_wait or self.futures[0].done()):
+                        break
+                    rows.append(self.futures.popleft().result())
+                if rows:
+                    database.executemany(self.sql, rows)
 
         def create_database():
             """Creates de basic structure of new database."""
             script = """
+                PRAGMA page_size = 8192;
                 PRAGMA journal_mode = OFF;
                 PRAGMA synchronous = OFF;
+                PRAGMA locking_mode = EXCLUSIVE;
+                PRAGMA cache_size = -262144;
                 CREATE TABLE tokens
                     (word TEXT,
                     docsets BLOB);
@@ -537,15 +1097,40 @@ class Index:
                     (pageid INTEGER PRIMARY KEY,
                     word_quants BLOB,
                     data BLOB);
+                CREATE TABLE meta
+                    (name TEXT PRIMARY KEY,
+                    value BLOB);
                 """
 
             database.executescript(script)
 
-        def add_docs_keys(source):
+        def order_source(source):
+            """Order the source by score, higher first, keeping the order of equal ones.
+
+            The source is stored in a staging table and ordered by SQLite, so it's
+            not held in memory. Return the quantity of items and an iterator on them.
+            """
+            database.execute("CREATE TABLE source (score INTEGER, data BLOB)")
+            sql = "INSERT INTO source (score, data) VALUES (?, ?)"
+            quantity = 0
+            buffer = []
+            for item in source:
+                buffer.append((item[2], pickle.dumps(item)))
+                if len(buffer) >= SOURCE_BATCH_SIZE:
+                    database.executemany(sql, buffer)
+                    quantity += len(buffer)
+                    buffer = []
+            database.executemany(sql, buffer)
+            quantity += len(buffer)
+
+            cur = database.execute("SELECT data FROM source ORDER BY score DESC, rowid")
+            return quantity, (pickle.loads(row[0]) for row in cur)
+
+        def add_docs_keys(source, quantity):
             """Add docs and keys registers to db and its rel in memory."""
-            idx_dict = defaultdict(DocSet)
+            postings = Postings(database)
             sql = "INSERT INTO docs (pageid, word_quants, data) VALUES (?, ?, ?)"
-            docs_table = Compressed("Documents", sql, len(source))
+            docs_table = Compressed("Documents", sql, quantity)
 
             for title, link, score, description, orig_words, redir_words in source:
                 idx_entry = IndexEntry(
@@ -558,8 +1143,7 @@ class Index:
                     idx_entry.link = None
                     idx_entry.rtype = IndexEntry.TYPE_ORIG_SIMPLE_LINK
                 orig_docid = docs_table.append((len(orig_words), idx_entry))
-                for idx, word in enumerate(orig_words):
-                    idx_dict[word].append(orig_docid, idx)
+                postings.add(orig_docid, orig_words)
                 for word_set in redir_words:
                     redir_entry = IndexEntry(
                         link=None,
@@ -569,17 +1153,16 @@ class Index:
                         rtype=IndexEntry.TYPE_REDIRECT,
                         orig_docid=orig_docid)
                     redir_docid = docs_table.append((len(word_set), redir_entry))
-                    for idx, word in enumerate(word_set):
-                        idx_dict[word].append(redir_docid, idx)
+                    postings.add(redir_docid, word_set)
 
             docs_table.finish()
-            return idx_dict
+            return postings
 
-        def add_tokens_to_db(idx_dict):
+        def add_tokens_to_db(postings):
             """Insert token words in the database."""
             sql_ins = "insert into tokens (word, docsets) values (?, ?)"
-            token_store = SQLmany("Tokens", sql_ins, len(idx_dict))
-            for word, docs_list in idx_dict.items():
+            token_store = SQLmany("Tokens", sql_ins, len(postings))
+            for word, docs_list in postings.docsets():
                 logger.debug("Word: %s %r" % (word, docs_list))
                 dict_stats["Indexed"] += len(docs_list)
                 token_store.append((word, docs_list))
@@ -588,6 +1171,8 @@ class Index:
         def create_indexes():
             script = '''
                 create index idx_words on tokens (word);
+                drop table if exists staging;
+                drop table source;
                 vacuum;
                 '''
             database.executescript(script)
@@ -597,13 +1182,21 @@ class Index:
         dict_stats = defaultdict(int)
         keyfilename = os.path.join(directory, "index.sqlite")
         database = open_connection(keyfilename)
-        create_database()
-        ordered_source = sorted(source, reverse=True, key=operator.itemgetter(2))
-        if not ordered_source:
-            raise ValueError("No data to index")
-        idx_dict = add_docs_keys(ordered_source)
-        add_tokens_to_db(idx_dict)
-        create_indexes()
+        # all the data is loaded in only one transaction, handled here
+        database.isolation_level = None
+        try:
+            create_database()
+            database.execute("BEGIN")
+            quantity, ordered_source = order_source(source)
+            if not quantity:
+                raise ValueError("No data to index")
+            postings = add_docs_keys(ordered_source, quantity)
+            add_tokens_to_db(postings)
+            database.execute("COMMIT")
+            create_indexes()
+        finally:
+            # release the exclusive lock
+            database.close()
         dict_stats["Total time"] = int(time.time() - initial_time)
         # Finally, show some statistics.
         for k, v in dict_stats.items():
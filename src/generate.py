@@ -167,6 +167,9 @@ def generate_libs():
         '--target={}'.format(dest_src),  # put all the resulting files in that specific dir
         '--requirement=requirements.txt',   # the running requirements
     ]
+    if config.INDEX_ZSTD:
+        # needed to read the index
+        cmd.append('--requirement=requirements-zstd.txt')
 
     proc = subprocess.Popen(
         cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
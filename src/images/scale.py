@@ -16,10 +16,12 @@
 
 """Reduce images based on precalculated scale values."""
 
+import concurrent.futures
 import config
 import logging
 import os
 import shutil
+import traceback
 from collections import Counter
 
 from PIL import Image
@@ -44,6 +46,34 @@ def scale_image(frompath, topath, scale_factor):
     logger.debug("Resized image saved at %s. Scaled to %d" % (topath, scale_factor))
 
 
+def _list_sizes(dirpath):
+    """Return the size of every file in the directory (nothing if it can't be listed)."""
+    try:
+        entries = list(os.scandir(dirpath))
+    except OSError:
+        return {}
+
+    sizes = {}
+    for entry in entries:
+        try:
+            if entry.is_file():
+                sizes[entry.name] = entry.stat().st_size
+        except OSError as err:
+            # only this image will be missing
+            logger.warning("Can't get the size of %r: %s", entry.path, err)
+    return sizes
+
+
+def _scale(task):
+    """Scale one image in a worker process, returning the error's traceback if any."""
+    frompath, topath, scale = task
+    try:
+        scale_image(frompath, topath, scale)
+    except Exception:
+        # the traceback is lost when the exception is sent to the main process
+        return traceback.format_exc()
+
+
 def run(verbose, src):
     """Reduce images using precalculated scales."""
     notfound = 0
@@ -68,6 +98,15 @@ def run(verbose, src):
 
     dst = os.path.join(config.DIR_IMGSLISTAS)
 
+    # images to scale, all done at the end in parallel
+    to_scale = []
+
+    # sizes of the source images, listing each directory only once
+    dir_sizes = {}
+
+    # destination directories already created
+    created_dirs = set()
+
     # load image path and its corresponding scale
     with open(config.LOG_REDUCCION, "rt", encoding="utf-8") as fh:
         for line in fh:
@@ -77,18 +116,22 @@ def run(verbose, src):
 
             frompath = os.path.join(src, dskurl)
             topath = os.path.join(dst, dskurl)
-            if not os.path.exists(frompath):
+            dirpath, fname = os.path.split(frompath)
+            if dirpath not in dir_sizes:
+                dir_sizes[dirpath] = _list_sizes(dirpath)
+            imgsize = dir_sizes[dirpath].get(fname)
+            if imgsize is None:
                 logger.warning("Don't have the img %r", frompath)
                 notfound += 1
                 continue
 
             # create the dir to hold it
-            dirname = os.path.dirname(topath)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
+            topath_dir = os.path.dirname(topath)
+            if topath_dir not in created_dirs:
+                os.makedirs(topath_dir, exist_ok=True)
+                created_dirs.add(topath_dir)
 
             # rules to skip scaling of some images: math/*, .png, .gif and < 2KB
-            imgsize = os.stat(frompath).st_size
             if dskurl.startswith('math') or imgsize < 2048:
                 scale = 100
             if dskurl.endswith(('.png', '.gif')):
@@ -113,11 +156,21 @@ def run(verbose, src):
                     shutil.copyfile(frompath, topath)
 
             else:
-                try:
-                    scale_image(frompath, topath, scale)
-                    done_now[dskurl] = scale
-                except Exception:
-                    logger.exception("Error processing %s", frompath)
+                to_scale.append((dskurl, frompath, topath, scale))
+
+    if to_scale:
+        tasks = [(frompath, topath, scale) for _, frompath, topath, scale in to_scale]
+        try:
+            with concurrent.futures.ProcessPoolExecutor() as executor:
+                errors = executor.map(_scale, tasks, chunksize=64)
+                for (dskurl, frompath, _, scale), error in zip(to_scale, errors):
+                    if error is None:
+                        done_now[dskurl] = scale
+                    else:
+                        logger.error("Error processing %s\n%s", frompath, error)
+        except Exception:
+            # e.g. a worker died; the images scaled so far are still saved as done
+            logger.exception("Scaling the images was interrupted")
 
     resize = done_now.values()
     rescale_tplt = ' - '.join('{} at {}%'.format(quant, scale)
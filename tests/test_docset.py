@@ -27,6 +27,41 @@ def test_delta_encode_decode():
     encoded = docset.delta_encode(values)
     assert values == docset.delta_decode(encoded)
 
+
+def test_delta_encode_decode_vectorized():
+    """Test encoding and decoding something long enough to be vectorized."""
+    values = [x * x for x in range(3000)]
+    encoded = sqlite_index.DocSet.delta_encode(values)
+    assert len(encoded) >= sqlite_index.VECTORIZED_DECODE_MIN
+    assert values == sqlite_index.DocSet.delta_decode(encoded)
+
+
+@pytest.mark.parametrize('values', (
+    [0, 1, 127, 128, 255, 16383, 16384, 2 ** 21, 2 ** 28, 2 ** 32 - 1],
+    [x * 3 for x in range(1000)],
+))
+def test_delta_encode_vectorized(values, monkeypatch):
+    """The vectorized encoding is the same than the pure Python one."""
+    vectorized = sqlite_index.DocSet._delta_encode_vectorized(values)
+    monkeypatch.setattr(sqlite_index, "VECTORIZED_ENCODE_MIN", len(values) + 1)
+    assert vectorized == sqlite_index.DocSet.delta_encode(values)
+
+
+def test_without_numpy(monkeypatch):
+    """Everything needed to read the index works without numpy."""
+    values = [x * x for x in range(3000)]
+    encoded = sqlite_index.DocSet.delta_encode(values)
+    monkeypatch.setattr(sqlite_index, "numpy", None)
+    assert encoded == sqlite_index.DocSet.delta_encode(values)
+    assert values == sqlite_index.DocSet.delta_decode(encoded)
+
+    docset = sqlite_index.DocSet()
+    for docid, position in [(7, 3), (2, 1), (7, 1), (5, 4)]:
+        docset.append(docid, position)
+    assert len(docset) == 3
+    assert sqlite_index.DocSet.decode(docset.encode()) == docset
+    assert sorted(docset.items()) == [(2, [1]), (5, [4]), (7, [1, 3])]
+
 # --- Test the DocSet class
 
 
@@ -67,6 +102,27 @@ def test_invalid_docset():
         docset.encode()
 
 
+def test_too_big_position():
+    """Positions are stored in a byte."""
+    docset = sqlite_index.DocSet()
+    with pytest.raises(ValueError):
+        docset.append(5, 300)
+
+
+def test_unordered_docset():
+    """The order of appending doesn't matter."""
+    docset = sqlite_index.DocSet()
+    for docid, position in [(7, 3), (2, 1), (7, 1), (5, 4)]:
+        docset.append(docid, position)
+    docset2 = sqlite_index.DocSet()
+    for docid, position in [(2, 1), (5, 4), (7, 1), (7, 3)]:
+        docset2.append(docid, position)
+    assert docset.encode() == docset2.encode()
+    assert docset == docset2
+    assert sorted(docset.items()) == [(2, [1]), (5, [4]), (7, [1, 3])]
+    assert len(docset) == 3
+
+
 def test_encode_decode_docset():
     """Test encode & decode a DocSet."""
     docset = sqlite_index.DocSet()
@@ -129,3 +185,46 @@ def test_to_empty_title():
     """Test to filename w/empty title error."""
     with pytest.raises(ValueError):
         sqlite_index.to_filename('')
+
+
+# ----- Test building the DocSets from the postings.
+
+
+def test_postings_docsets():
+    """All pairs are grouped by word, in order."""
+    postings = sqlite_index.Postings()
+    postings.add(0, ("ala", "blanca"))
+    postings.add(1, ("blanca", "nieves", "blanca"))
+    postings.add(2, ("ala",))
+    assert len(postings) == 3
+
+    expected = {"ala": [(0, 0), (2, 0)], "blanca": [(0, 1), (1, 0), (1, 2)], "nieves": [(1, 1)]}
+    for word, docset in postings.docsets():
+        expected_docset = sqlite_index.DocSet()
+        for docid, position in expected.pop(word):
+            expected_docset.append(docid, position)
+        assert docset == expected_docset
+        assert docset.encode() == expected_docset.encode()
+    assert not expected
+
+
+def test_postings_too_many_words():
+    """Positions are stored in a byte."""
+    postings = sqlite_index.Postings()
+    with pytest.raises(ValueError):
+        postings.add(0, ["word"] * 256)
+
+
+def test_postings_staged():
+    """Pairs staged in the database in several batches are the same than all at once."""
+    titles = [("ala", "blanca"), ("conejo", "blanco"), ("blanca", "nieves", "blanca"),
+              ("ala",), ("conejo", "negro", "ala")] * 5
+    in_memory = sqlite_index.Postings()
+    con = sqlite_index.open_connection(":memory:")
+    staged = sqlite_index.Postings(con, batch_size=4)
+    for docid, words in enumerate(titles):
+        in_memory.add(docid, words)
+        staged.add(docid, words)
+    assert len(staged) == len(in_memory) == 6
+    assert dict(staged.docsets()) == dict(in_memory.docsets())
+    assert con.execute("SELECT COUNT(*) FROM staging").fetchone()[0] > 6
@@ -15,6 +15,10 @@
 # For further info, check  https://github.com/PyAr/CDPedia/
 
 
+import concurrent.futures
+import lzma
+import pickle
+
 import pytest
 
 from src.armado import sqlite_index
@@ -36,13 +40,16 @@ def to_idx_data(titles):
     return [[ttl.strip(), ttl.strip(), 0, '', tokenize(ttl), set()] for ttl in titles]
 
 
-@pytest.fixture()
-def create_index(tmpdir):
-    """Create an index with given info in a temp dir, load it and return built index."""
+@pytest.fixture(params=[False, True], ids=["lzma", "zstd"])
+def create_index(tmpdir, request):
+    """Create an index with given info in a temp dir, load it and return built index.
+
+    The index is created with and without zstandard compression.
+    """
 
     def f(info):
         # Create the index with the parametrized engine
-        sqlite_index.Index.create(str(tmpdir), info)
+        sqlite_index.Index.create(str(tmpdir), info, zstd=request.param)
 
         # Load the index and give it to use
         index = sqlite_index.Index(str(tmpdir))
@@ -172,6 +179,13 @@ def test_search_prefix(create_index):
     assert list(res) == []
 
 
+def test_search_quotes(create_index):
+    """Keys are passed as query parameters, quotes are fine."""
+    idx = create_index(to_idx_data(["o'higgins", "conejo blanco"]))
+    res = list(idx.search(["o'hig"]))
+    assert res == [get_ie("o'higgins")]
+
+
 def test_search_several_values(create_index):
     """Several values stored."""
     data = ["aaa", "abc", "bcd", "abd", "bbd"]
@@ -212,3 +226,183 @@ def test_redir(create_index):
     idx_entry.rtype = IndexEntry.TYPE_REDIRECT
     idx_entry.subtitle = "zzz xxx"
     assert set(res) == {idx_entry}
+
+
+# --- Test the order of the documents.
+
+
+def test_ordered_by_score(create_index, monkeypatch):
+    """Documents are stored by score, higher first, keeping the order of ties."""
+    monkeypatch.setattr(sqlite_index, "SOURCE_BATCH_SIZE", 2)
+    data = to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "gato", "perro"])
+    for item, score in zip(data, [3, 7, 3, 9, 3]):
+        item[2] = score
+    idx = create_index(data)
+    titles = [idx.get_doc(docid).title for docid in range(len(data))]
+    assert titles == ["gato", "conejo blanco", "ala blanca", "conejo negro", "perro"]
+
+
+# --- Test the pages compression.
+
+
+def test_several_pages(create_index, monkeypatch):
+    """Several pages, some of them compressed after training the dictionary."""
+    monkeypatch.setattr(sqlite_index, "PAGE_SIZE", 4)
+    monkeypatch.setattr(sqlite_index, "ZSTD_DICT_SAMPLES", 3)
+    titles = ["articulo numero {}".format(i) for i in range(50)]
+    idx = create_index(to_idx_data(titles))
+    assert set(idx.values()) == {get_ie(ttl) for ttl in titles}
+    assert len(idx) == len(titles)
+    res = list(idx.search(["numero", "33"]))
+    assert res == [get_ie("articulo numero 33")]
+
+
+def test_staged_postings(create_index, monkeypatch):
+    """The words' DocSets are the same when staged in several batches."""
+    monkeypatch.setattr(sqlite_index, "POSTINGS_BATCH_SIZE", 3)
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "ala"]))
+    assert set(idx.keys()) == {"ala", "blanca", "blanco", "conejo", "negro"}
+    res = idx.search(["ala"])
+    assert set(res) == {get_ie('ala blanca'), get_ie('ala')}
+    res = idx.search(["conejo", "negro"])
+    assert set(res) == {get_ie('conejo negro')}
+
+
+def test_lzma_pages(tmpdir):
+    """By default the pages are stored by columns, LZMA compressed."""
+    titles = ["ala blanca", "conejo blanco", "conejo negro"]
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(titles))
+    idx = sqlite_index.Index(str(tmpdir))
+    data = idx.db.execute("SELECT data FROM docs").fetchone()[0]
+    assert data[:1] == sqlite_index.PAGE_FORMAT_COLUMNS
+    assert lzma.decompress(data[1:])
+    assert set(idx.values()) == {get_ie(ttl) for ttl in titles}
+    assert set(idx.search(["conejo"])) == {get_ie('conejo blanco'), get_ie('conejo negro')}
+
+
+def test_without_zstandard(create_index, monkeypatch):
+    """The index is created and read without zstandard."""
+    monkeypatch.setattr(sqlite_index, "zstandard", None)
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco"]))
+    assert list(idx.search(["ala"])) == [get_ie("ala blanca")]
+    assert idx.get_doc(1) == get_ie("conejo blanco")
+
+
+def test_create_without_numpy(tmpdir, monkeypatch):
+    """The index can't be created without numpy."""
+    monkeypatch.setattr(sqlite_index, "numpy", None)
+    with pytest.raises(RuntimeError):
+        sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]))
+
+
+def test_compressor_roundtrip():
+    """Compress and decompress with and without dictionary."""
+    samples = [pickle.dumps(["title {}".format(i)] * i) for i in range(200)]
+    for compressor in (sqlite_index.Compressor(), sqlite_index.Compressor.train(samples)):
+        compressed = compressor.compress(samples[10])
+        assert not compressed.startswith(b"\x28\xb5\x2f\xfd")  # no zstd magic number
+        assert compressor.decompress(compressed) == samples[10]
+        assert compressor.decompress(compressed) == samples[10]
+
+
+def test_worker_compressor_cached():
+    """The worker processes build the compressor only once for each dictionary."""
+    samples = [pickle.dumps(["title {}".format(i)] * i) for i in range(200)]
+    dict_data = sqlite_index.Compressor.train(samples).dict_data
+    compressor = sqlite_index._get_worker_compressor(dict_data)
+    assert compressor.dict_data == dict_data
+    assert sqlite_index._get_worker_compressor(bytes(dict_data)) is compressor
+    assert sqlite_index._get_worker_compressor(None) is not compressor
+
+
+def test_compressor_threads():
+    """Each thread decompresses with its own decompressor."""
+    compressor = sqlite_index.Compressor()
+    compressed = compressor.compress(b"ala blanca" * 10)
+    assert compressor.decompress(compressed) == b"ala blanca" * 10
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(compressor.decompress, [compressed] * 20))
+    assert results == [b"ala blanca" * 10] * 20
+
+
+def test_page_rows():
+    """Each document of a page is compressed by itself."""
+    entries = [get_ie("ala blanca"), get_ie("conejo blanco")]
+    entries[1].rtype = IndexEntry.TYPE_REDIRECT
+    entries[1].link = None
+    entries[1].orig_docid = 7
+    compressor = sqlite_index.Compressor()
+    data = sqlite_index.compress_page(sqlite_index.encode_page(entries), compressor)
+    assert data[:1] == sqlite_index.PAGE_FORMAT_ROWS
+    page = sqlite_index.decompress_data(data, compressor)
+    assert len(page) == 2
+    assert list(page) == entries
+    assert page[1] == entries[1]
+    with pytest.raises(IndexError):
+        page[2]
+
+
+def test_page_rows_dictionary():
+    """The rows are compressed with the trained dictionary."""
+    entries = [get_ie("articulo numero {}".format(i)) for i in range(200)]
+    encoded = sqlite_index.encode_page(entries)
+    compressor = sqlite_index.Compressor.train(encoded)
+    data = sqlite_index.compress_page(encoded, compressor)
+    page = sqlite_index.decompress_data(data, compressor)
+    assert page[133] == entries[133]
+
+
+def test_page_columns():
+    """Pages are serialized by columns to be LZMA compressed."""
+    entries = [get_ie("ala blanca"), get_ie("conejo blanco")]
+    entries[1].rtype = IndexEntry.TYPE_REDIRECT
+    entries[1].link = None
+    entries[1].orig_docid = 7
+    data = sqlite_index.compress_columns_page(entries)
+    assert data[:1] == sqlite_index.PAGE_FORMAT_COLUMNS
+    page = sqlite_index.decompress_data(data, None)
+    assert len(page) == 2
+    assert list(page) == entries
+    assert page[1] == entries[1]
+
+
+def test_page_legacy_format():
+    """Pages from old indexes are a pickle compressed with LZMA."""
+    entries = [get_ie("ala blanca"), get_ie("conejo blanco")]
+    compressor = sqlite_index.Compressor()
+    pickled = pickle.dumps(entries)
+    assert sqlite_index.decompress_data(lzma.compress(pickled), compressor) == entries
+
+
+# --- Test the pages cache.
+
+
+def test_page_cache_lru():
+    """Least recently used pages are evicted when going over the size limit."""
+    cache = sqlite_index.PageCache(100)
+    cache.put(1, "page 1", 40)
+    cache.put(2, "page 2", 40)
+    assert cache.get(1) == "page 1"
+    cache.put(3, "page 3", 40)
+    assert cache.get(2) is None
+    assert cache.get(1) == "page 1"
+    assert cache.get(3) == "page 3"
+    assert cache.size == 80
+
+
+def test_page_cache_big_page():
+    """A page bigger than the limit is kept anyway, alone."""
+    cache = sqlite_index.PageCache(100)
+    cache.put(1, "page 1", 40)
+    cache.put(2, "page 2", 400)
+    assert cache.get(1) is None
+    assert cache.get(2) == "page 2"
+    assert cache.size == 400
+
+
+def test_page_cache_used(create_index, monkeypatch):
+    """Pages are fetched only once from the database while in the cache."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco"]))
+    idx.get_doc(0)
+    monkeypatch.setattr(idx, "db", None)
+    assert idx.get_doc(1) == get_ie("conejo blanco")
@@ -0,0 +1,36 @@
+# Copyright 2020 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+
+"""Tests for the 'makeLista' utility."""
+
+import os
+
+from utilities.makeLista import analizar
+
+
+def test_analizar(tmp_path):
+    """Files are accumulated by root in all the tree, skipping the entries that fail."""
+    (tmp_path / "a~x").write_bytes(b"1234")
+    (tmp_path / "z~y").write_bytes(b"12")
+    (tmp_path / "sinraiz").write_bytes(b"1")
+    os.symlink(str(tmp_path / "missing"), str(tmp_path / "roto~x"))
+    subdir = tmp_path / "d" / "e"
+    subdir.mkdir(parents=True)
+    (tmp_path / "d" / "b~x").write_bytes(b"123")
+    (subdir / "c~z").write_bytes(b"12345")
+
+    result = analizar(str(tmp_path), hilos=3)
+    assert result == {"a": (1, 4), "b": (1, 3), "c": (1, 5), "z": (1, 2), "None": (1, 1)}
@@ -16,11 +16,14 @@
 
 """Tests for the 'scale' module."""
 
+import concurrent.futures
 import unittest
 import os
+import shutil
 
+import config
 from PIL import Image
-from src.images.scale import scale_image
+from src.images.scale import _list_sizes, _scale, run, scale_image
 
 
 class ScaleImagesTestCase(unittest.TestCase):
@@ -39,3 +42,76 @@ class ScaleImagesTestCase(unittest.TestCase):
 
     def tearDown(self):
         os.remove(self.scaled)
+
+
+def _prepare_run(mocker, tmp_path):
+    """Prepare the images and the configuration to run the scaling."""
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    mocker.patch('config.DIR_IMGSLISTAS', str(dst))
+    mocker.patch('config.LOG_REDUCCION', str(tmp_path / 'reduccion.txt'))
+    mocker.patch('config.LOG_REDUCDONE', str(tmp_path / 'reduc_done.txt'))
+    mocker.patch('config.LOG_IMAGES_EMBEDDED', str(tmp_path / 'images_embed.txt'))
+    mocker.patch('config.EMBED_IMAGES', False)
+
+    # a big image to be scaled, and a small one to be copied
+    (src / 'a' / 'b').mkdir(parents=True)
+    noise = Image.effect_noise((200, 100), 100).convert('RGB')
+    noise.save(str(src / 'a' / 'b' / 'big.jpg'))
+    shutil.copyfile(os.path.join('tests', 'fixtures', 'image-to-scale.jpg'),
+                    str(src / 'a' / 'small.jpg'))
+    with open(config.LOG_REDUCCION, 'wt', encoding='utf-8') as fh:
+        fh.write('50|a/b/big.jpg\n50|a/small.jpg\n75|a/missing.jpg\n75|a/small.jpg/bad.jpg\n')
+    return src, dst
+
+
+def test_run(mocker, tmp_path):
+    """Images are scaled or just copied, following the rules."""
+    src, dst = _prepare_run(mocker, tmp_path)
+    notfound = run(False, str(src))
+    assert notfound == 2
+    assert Image.open(str(dst / 'a' / 'b' / 'big.jpg')).size == (100, 50)
+    assert Image.open(str(dst / 'a' / 'small.jpg')).size == (50, 50)
+    with open(config.LOG_REDUCDONE, 'rt', encoding='utf-8') as fh:
+        assert sorted(fh) == [' 50 a/b/big.jpg\n', '100 a/small.jpg\n']
+
+
+def test_run_interrupted(mocker, tmp_path):
+    """If the processes pool breaks, the images scaled so far are still saved as done."""
+    src, dst = _prepare_run(mocker, tmp_path)
+
+    class BrokenExecutor(concurrent.futures.ThreadPoolExecutor):
+        def map(self, func, tasks, chunksize=1):
+            raise concurrent.futures.process.BrokenProcessPool()
+
+    mocker.patch('concurrent.futures.ProcessPoolExecutor', BrokenExecutor)
+    run(False, str(src))
+    assert not (dst / 'a' / 'b' / 'big.jpg').exists()
+    with open(config.LOG_REDUCDONE, 'rt', encoding='utf-8') as fh:
+        assert list(fh) == ['100 a/small.jpg\n']
+
+
+def test_scale_error(tmp_path):
+    """The errors are returned from the worker processes with their traceback."""
+    error = _scale((str(tmp_path / 'missing.jpg'), str(tmp_path / 'scaled.jpg'), 50))
+    assert error.startswith('Traceback')
+    assert 'missing.jpg' in error
+
+
+def test_list_sizes(mocker, tmp_path):
+    """Only the entries that fail are left out, not the whole directory."""
+    (tmp_path / 'good.jpg').write_bytes(b'123')
+    (tmp_path / 'bad.jpg').write_bytes(b'12345')
+    real_scandir = os.scandir
+
+    def fake_scandir(dirpath):
+        entries = list(real_scandir(dirpath))
+        for entry in entries:
+            if entry.name == 'bad.jpg':
+                entries[entries.index(entry)] = mocker.Mock(
+                    path=entry.path, is_file=mocker.Mock(side_effect=PermissionError()))
+        return entries
+
+    mocker.patch('os.scandir', fake_scandir)
+    assert _list_sizes(str(tmp_path)) == {'good.jpg': 3}
+    assert _list_sizes(str(tmp_path / 'good.jpg')) == {}
@@ -19,7 +19,9 @@
 from __future__ import print_function
 
 import os
+import queue
 import sys
+import threading
 
 usage = """
 Use: makeLista.py <directory>
@@ -31,37 +33,83 @@ Use: makeLista.py <directory>
     The program shows the list and percentages using stdout
 """
 
-PASOSHOW = 1000
+# quantity of threads listing directories at the same time
+HILOS = 8
+
+
+def analizar(nomdir, hilos=HILOS):
+    """Return the quantity and size of the files under the directory, by root.
+
+    The directories are listed in parallel by several threads, each one accumulating
+    its own results, that are joined at the end.
+    """
+    pendientes = queue.Queue()
+    pendientes.put(nomdir)
+    resultados = []
+
+    def trabajador():
+        acum = {}
+        while True:
+            dirpath = pendientes.get()
+            if dirpath is None:
+                break
+            try:
+                try:
+                    # all listed at once, as the iterator can't be used in a 'with'
+                    # before Python 3.6 (it's closed when exhausted)
+                    entradas = list(os.scandir(dirpath))
+                except OSError:
+                    # as os.walk, ignore the directories that can not be listed
+                    entradas = []
+
+                for entrada in entradas:
+                    try:
+                        if entrada.is_dir():
+                            # as os.walk, don't go into symlinked directories
+                            if not entrada.is_symlink():
+                                pendientes.put(entrada.path)
+                            continue
+                        tamanio = entrada.stat().st_size
+                    except OSError as err:
+                        # only this entry is left out (e.g. a broken symlink)
+                        print("Ignoring %r: %s" % (entrada.path, err), file=sys.stderr)
+                        continue
+
+                    if "~" in entrada.name:
+                        raiz = entrada.name.split("~", 1)[0]
+                    else:
+                        raiz = "None"
+                    (cant, tam) = acum.get(raiz, (0, 0))
+                    acum[raiz] = (cant + 1, tam + tamanio)
+            finally:
+                pendientes.task_done()
+        resultados.append(acum)
+
+    trabajadores = [threading.Thread(target=trabajador) for _ in range(hilos)]
+    for hilo in trabajadores:
+        hilo.start()
+
+    # subdirectories are queued before finishing its parent, so when everything
+    # is done there's nothing else to list
+    pendientes.join()
+    for hilo in trabajadores:
+        pendientes.put(None)
+    for hilo in trabajadores:
+        hilo.join()
 
-
-def main(nomdir):
-    total = tamtotal = 0
     acum = {}
-    pasoant = 0
+    for parcial in resultados:
+        for raiz, (cant, tam) in parcial.items():
+            (cant_ant, tam_ant) = acum.get(raiz, (0, 0))
+            acum[raiz] = (cant_ant + cant, tam_ant + tam)
+    return acum
 
+
+def main(nomdir):
     print("Analyzing %r..." % nomdir)
-    for cwd, directorios, archivos in os.walk(nomdir):
-        for fname in archivos:
-            fullpath = os.path.join(cwd, fname)
-
-            tamanio = os.stat(fullpath).st_size
-            tamtotal += tamanio
-
-            if "~" in fname:
-                raiz = fname.split("~")[0].decode("utf-8")
-            else:
-                raiz = "None"
-
-            (cant, tam) = acum.get(raiz, (0, 0))
-            cant += 1
-            tam += tamanio
-            acum[raiz] = (cant, tam)
-            total += 1
-
-            if total // PASOSHOW > pasoant:
-                sys.stdout.write("\r%d...     " % total)
-                sys.stdout.flush()
-                pasoant = total // PASOSHOW
+    acum = analizar(nomdir)
+    total = sum(cant for cant, _ in acum.values())
+    tamtotal = sum(tam for _, tam in acum.values())
 
     print("\nShowing the results for a total of %d files that occupy %.2f MB:\n" % (
         total, tamtotal / 1048576.0))